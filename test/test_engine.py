@@ -142,6 +142,37 @@ class EngineTester(unittest.TestCase):
         self.assertIsInstance(out[0]["labels"], Tensor)
         self.assertIsInstance(out[0]["scores"], Tensor)
 
+    def test_predict_with_batched_tensor(self):
+        # Set image inputs at the resolution of the model
+        img_tensor = torch.rand((2, 3, 320, 416), dtype=torch.float32)
+        # Load model
+        model = yolov5s(pretrained=True)
+        model.eval()
+        # Perform inference on a batched tensor
+        out = model(img_tensor)
+        out_expected = model(list(img_tensor.unbind(0)))
+        self.assertIsInstance(out, list)
+        self.assertEqual(len(out), 2)
+        self.assertIsInstance(out[0], Dict)
+        self.assertTrue(out[0]["boxes"].equal(out_expected[0]["boxes"]))
+        self.assertTrue(out[0]["labels"].equal(out_expected[0]["labels"]))
+        self.assertTrue(out[0]["scores"].equal(out_expected[0]["scores"]))
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA unavailable")
+    def test_predict_with_amp(self):
+        # Set image inputs at the resolution of the model, which skips the rescaling
+        img_tensor = torch.rand((2, 3, 320, 416), dtype=torch.float32, device='cuda')
+        # Load model
+        model = yolov5s(pretrained=True, amp=True)
+        model.eval()
+        model = model.cuda()
+        # Perform inference on the batched tensor fast path and the list path
+        for inputs in (img_tensor, list(img_tensor.unbind(0))):
+            with torch.no_grad():
+                predictions = model(inputs)
+            self.assertEqual(predictions[0]["boxes"].dtype, torch.float32)
+            self.assertEqual(predictions[0]["scores"].dtype, torch.float32)
+
     def test_predict_with_tensor(self):
         # Set image inputs
         img_name = "test/assets/zidane.jpg"
@@ -1,11 +1,13 @@
 # Copyright (c) 2020, Zhiqiang Wang. All Rights Reserved.
 import unittest
 import torch
+from torchvision.ops import box_iou
 
 from yolort.models.backbone_utils import darknet_pan_backbone
 from yolort.models.transformer import darknet_tan_backbone
 from yolort.models.anchor_utils import AnchorGenerator
 from yolort.models.box_head import YOLOHead, PostProcess, SetCriterion
+from yolort.models._utils import _evaluate_iou
 
 from .common_utils import TestCase
 
@@ -207,6 +209,19 @@ class ModelTester(TestCase):
         model = self._init_test_criterion()
         scripted_model = torch.jit.script(model)  # noqa
 
+    def test_evaluate_iou(self):
+        boxes = torch.tensor([[10., 20., 50., 60.], [30., 30., 80., 90.], [0., 0., 40., 40.]])
+        targets = [{"boxes": boxes}, {"boxes": boxes[:2]}, {"boxes": boxes}]
+        preds = [{"boxes": boxes + 5.}, {"boxes": boxes + 2.}, {"boxes": torch.zeros((0, 4))}]
+
+        iou = _evaluate_iou(targets, preds)
+        iou_expected = torch.stack([
+            box_iou(targets[0]["boxes"], preds[0]["boxes"]).diag().mean(),
+            box_iou(targets[1]["boxes"], preds[1]["boxes"]).diag().mean(),
+            torch.tensor(0.),
+        ]).mean()
+        self.assertTrue(torch.allclose(iou, iou_expected))
+
 
 class AnchorGeneratorTester(TestCase):
     def _init_test_anchor_generator(self):
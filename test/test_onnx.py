@@ -4,6 +4,8 @@ Test for exporting model to ONNX and inference with ONNXRuntime
 """
 import io
 import unittest
+import tempfile
+from pathlib import Path
 
 try:
     # This import should be before that of torch if you are using PyTorch lower than 1.5.0
@@ -151,3 +153,22 @@ class ONNXExporterTester(unittest.TestCase):
                        output_names=["outputs"],
                        dynamic_axes={"images_tensors": [0, 1, 2], "outputs": [0, 1, 2]},
                        tolerate_small_mismatch=True)
+
+    def test_yolov5s_export_onnx(self):
+        images_one, images_two = self.get_test_images()
+        model = yolov5s(upstream_version='r4.0', export_friendly=True, pretrained=True, score_thresh=0.45)
+        model.train()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            onnx_path = Path(tmp_dir) / 'yolov5s.onnx'
+            model.export(onnx_path, fmt='onnx', example_inputs=images_one)
+            onnx_io = io.BytesIO(onnx_path.read_bytes())
+
+        # The train/eval mode is restored after exporting
+        self.assertTrue(model.training)
+        model.eval()
+        # Test exported model on images of different size
+        for test_inputs in (images_one, images_two):
+            with torch.no_grad():
+                test_ouputs = model(test_inputs)
+            self.ort_validate(onnx_io, (test_inputs,), test_ouputs, tolerate_small_mismatch=True)
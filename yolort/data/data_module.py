@@ -54,6 +54,7 @@ class DetectionDataModule(LightningDataModule):
             batch_sampler=batch_sampler,
             collate_fn=collate_fn,
             num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
         )
 
         return loader
@@ -75,6 +76,7 @@ class DetectionDataModule(LightningDataModule):
             drop_last=False,
             collate_fn=collate_fn,
             num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
         )
 
         return loader
@@ -17,7 +17,7 @@ class ObjectDetectionDataPipeline(DataPipeline):
     """
     def __init__(self, loader: Optional[Callable] = None):
         if loader is None:
-            loader = lambda x: read_image(x) / 255.
+            loader = _default_loader
         self._loader = loader
 
     def before_collate(self, samples: Any) -> Any:
@@ -51,6 +51,11 @@ class ObjectDetectionDataPipeline(DataPipeline):
         return (batch["x"], batch["target"]) if isinstance(batch, dict) else (batch, None)
 
 
+def _default_loader(img_name: str) -> Tensor:
+    # a module level function rather than a lambda, keeping the pipeline picklable
+    return read_image(img_name) / 255.
+
+
 def _contains_any_tensor(value: Any, dtype: Type = Tensor) -> bool:
     """
     TODO: we should refactor FlashDatasetFolder to better integrate
@@ -4,19 +4,41 @@ import math
 import torch
 from torch import Tensor
 import torch.nn.functional as F
-from torchvision.ops import box_convert, box_iou
+from torch.nn.utils.rnn import pad_sequence
+from torchvision.ops import box_convert
 
-from typing import Tuple
+from typing import Tuple, List, Dict
 
 
-def _evaluate_iou(target, pred):
+def _evaluate_iou(targets: List[Dict[str, Tensor]], preds: List[Dict[str, Tensor]]) -> Tensor:
     """
-    Evaluate intersection over union (IOU) for target from dataset and output prediction from model
+    Evaluate intersection over union (IOU) for targets from dataset and output predictions from model.
+    The i-th target box is paired with the i-th predicted box of each image, and the IOUs of the padded
+    boxes are evaluated in a single batched call, the mean of the per-image IOUs is returned.
     """
-    if pred["boxes"].shape[0] == 0:
-        # no box detected, 0 IOU
-        return torch.tensor(0.0, device=pred["boxes"].device)
-    return box_iou(target["boxes"], pred["boxes"]).diag().mean()
+    device = preds[0]["boxes"].device
+    target_boxes = pad_sequence([t["boxes"] for t in targets], batch_first=True).to(device)
+    pred_boxes = pad_sequence([p["boxes"] for p in preds], batch_first=True)
+    counts = torch.tensor(
+        [min(t["boxes"].shape[0], p["boxes"].shape[0]) for t, p in zip(targets, preds)],
+        device=device,
+    )
+
+    num_boxes = min(target_boxes.shape[1], pred_boxes.shape[1])
+    target_boxes = target_boxes[:, :num_boxes]
+    pred_boxes = pred_boxes[:, :num_boxes]
+
+    lt = torch.max(target_boxes[..., :2], pred_boxes[..., :2])
+    rb = torch.min(target_boxes[..., 2:], pred_boxes[..., 2:])
+    inter = (rb - lt).clamp(min=0).prod(dim=-1)
+    area_target = (target_boxes[..., 2:] - target_boxes[..., :2]).prod(dim=-1)
+    area_pred = (pred_boxes[..., 2:] - pred_boxes[..., :2]).prod(dim=-1)
+    iou = inter / (area_target + area_pred - inter)
+
+    valid = torch.arange(num_boxes, device=device)[None] < counts[:, None]
+    iou = torch.where(valid, iou, torch.zeros_like(iou))
+    # no box detected, 0 IOU
+    return (iou.sum(dim=1) / counts.clamp(min=1)).mean()
 
 
 class BoxCoder(object):
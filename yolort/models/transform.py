@@ -17,11 +17,11 @@ class NestedTensor(object):
     This works by padding the images to the same size,
     and storing in a field the original sizes of each image
     """
-    def __init__(self, tensors: Tensor, image_sizes: List[Tuple[int, int]]):
+    def __init__(self, tensors: Tensor, image_sizes: Tensor):
         """
         Args:
             tensors (Tensor)
-            image_sizes (list[tuple[int, int]])
+            image_sizes (Tensor): the heights and widths of images, w/ shape: batch_size x 2
         """
         self.tensors = tensors
         self.image_sizes = image_sizes
@@ -85,14 +85,9 @@ class GeneralizedYOLOTransform(nn.Module):
             if targets is not None and target_index is not None:
                 targets[i] = target_index
 
-        image_sizes = [img.shape[-2:] for img in images]
+        image_sizes = get_image_sizes(images)
         images = nested_tensor_from_tensor_list(images)
-        image_sizes_list: List[Tuple[int, int]] = []
-        for image_size in image_sizes:
-            assert len(image_size) == 2
-            image_sizes_list.append((image_size[0], image_size[1]))
-
-        image_list = NestedTensor(images, image_sizes_list)
+        image_list = NestedTensor(images, image_sizes)
 
         if targets is not None:
             targets_batched = []
@@ -147,23 +142,52 @@ class GeneralizedYOLOTransform(nn.Module):
     def postprocess(
         self,
         result: Tuple[Dict[str, Tensor], List[Dict[str, Tensor]]],
-        image_shapes: List[Tuple[int, int]],
-        original_image_sizes: List[Tuple[int, int]],
+        image_shapes: Tensor,
+        original_image_sizes: Tensor,
     ) -> List[Dict[str, Tensor]]:
+        """
+        Args:
+            result: the (Losses, Detections) tuple of the model
+            image_shapes (Tensor): the transformed image sizes, w/ shape: batch_size x 2
+            original_image_sizes (Tensor): the original image sizes, w/ shape: batch_size x 2
+        """
+        predictions = result[1]
 
-        if torch.jit.is_scripting():
-            predictions = result[1]
-        else:
-            predictions = result
+        # Skip the rescaling when the images are fed at the resolution of the model
+        if not torchvision._is_tracing() and torch.equal(image_shapes, original_image_sizes):
+            return predictions
+
+        # Rescale ratios of the boxes in [x1, y1, x2, y2] format, w/ shape: batch_size x 4
+        ratios = original_image_sizes / image_shapes
+        ratio_height, ratio_width = ratios[:, 0:1], ratios[:, 1:2]
+        ratios = torch.cat((ratio_width, ratio_height, ratio_width, ratio_height), dim=1)
 
-        for i, (pred, im_s, o_im_s) in enumerate(zip(predictions, image_shapes, original_image_sizes)):
-            boxes = pred["boxes"]
-            boxes = resize_boxes(boxes, im_s, o_im_s)
-            predictions[i]["boxes"] = boxes
+        for i, pred in enumerate(predictions):
+            predictions[i]["boxes"] = pred["boxes"] * ratios[i]
 
         return predictions
 
 
+def get_image_sizes(images: List[Tensor]) -> Tensor:
+    """
+    Collect the heights and widths of images into a tensor, w/ shape: batch_size x 2
+    """
+    if torchvision._is_tracing():
+        # torch.tensor() will record the image sizes as constants in the tracing graph,
+        # call _onnx_get_image_sizes() instead
+        return _onnx_get_image_sizes(images)
+
+    return torch.tensor([img.shape[-2:] for img in images], dtype=torch.float32, device=images[0].device)
+
+
+@torch.jit.unused
+def _onnx_get_image_sizes(images: List[Tensor]) -> Tensor:
+    from torch.onnx import operators
+
+    image_sizes = torch.stack([operators.shape_as_tensor(img)[-2:] for img in images])
+    return image_sizes.to(dtype=torch.float32, device=images[0].device)
+
+
 def nested_tensor_from_tensor_list(tensor_list: List[Tensor], size_divisible: int = 32):
     # TODO make this more general
     if tensor_list[0].ndim == 3:
@@ -1,15 +1,17 @@
 # Copyright (c) 2021, Zhiqiang Wang. All Rights Reserved.
 import warnings
+import weakref
 import argparse
 from pathlib import PosixPath
 
 import torch
 from torch import Tensor
+import torchvision
 
 from pytorch_lightning import LightningModule
 
 from . import yolo
-from .transform import GeneralizedYOLOTransform
+from .transform import GeneralizedYOLOTransform, NestedTensor, get_image_sizes
 from ._utils import _evaluate_iou
 from ..data import DetectionDataModule, DataPipeline, COCOEvaluator
 
@@ -17,6 +19,9 @@ from typing import Any, List, Dict, Tuple, Optional, Union
 
 __all__ = ['YOLOModule']
 
+# Scripted copies of the transforms, keyed by the YOLOModule using them
+_TRANSFORM_SCRIPTED_CACHE = weakref.WeakKeyDictionary()
+
 
 class YOLOModule(LightningModule):
     """
@@ -32,6 +37,9 @@ class YOLOModule(LightningModule):
         min_size: int = 320,
         max_size: int = 416,
         annotation_path: Optional[Union[str, PosixPath]] = None,
+        compile_model: bool = False,
+        amp: bool = False,
+        channels_last: bool = False,
         **kwargs: Any,
     ):
         """
@@ -40,23 +48,52 @@ class YOLOModule(LightningModule):
             lr: the learning rate
             pretrained: if true, returns a model pre-trained on COCO train2017
             num_classes: number of detection classes (doesn't including background)
+            compile_model: if true, wraps the detector with ``torch.compile`` (PyTorch 2.0+),
+                the compiled model can not be exported by TorchScript. Call ``warmup`` ahead of
+                the inference to pay for the compilation. The checkpoints keep the same keys
+                with or without compiling.
+            amp: if true, runs the eager inference on cuda device with FP16 autocast
+            channels_last: if true, uses the channels last memory format for the convolutions
         """
         super().__init__()
 
         self.lr = lr
         self.num_classes = num_classes
+        self.amp = amp
+        self.channels_last = channels_last
 
         self.model = yolo.__dict__[arch](
             pretrained=pretrained, progress=progress, num_classes=num_classes, **kwargs)
 
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        self._is_compiled = False
+        if compile_model:
+            if hasattr(torch, 'compile'):
+                # CUDA graphs can only be captured when the input shapes are static
+                self.model = torch.compile(self.model, mode='reduce-overhead', dynamic=(min_size != max_size))
+                self._is_compiled = True
+                # Keep the state_dict keys compatible with the uncompiled model
+                self._register_state_dict_hook(_strip_compiled_prefix)
+                self._register_load_state_dict_pre_hook(self._add_compiled_prefix)
+            else:
+                warnings.warn("torch.compile is only available on PyTorch 2.0+, skip compiling the model.")
+
         self.transform = GeneralizedYOLOTransform(min_size, max_size)
 
-        self._data_pipeline = None
+        self._data_pipeline = self.default_pipeline()
 
         # metrics
+        self.register_buffer('_val_iou_sum', torch.zeros(()), persistent=False)
+        self.register_buffer('_val_iou_count', torch.zeros((), dtype=torch.long), persistent=False)
         self.evaluator = None
         if annotation_path is not None:
             self.evaluator = COCOEvaluator(annotation_path, iou_type="bbox")
+        # the test predictions are fed to the evaluator in chunks of images
+        self._eval_chunk_size = 64
+        self._pending_test_preds: List[Dict[str, Tensor]] = []
+        self._pending_test_targets: List[Dict[str, Tensor]] = []
 
         # used only on torchscript mode
         self._has_warned = False
@@ -77,30 +114,27 @@ class YOLOModule(LightningModule):
                 During testing, it returns list[BoxList] contains additional fields
                 like `scores`, `labels` and `mask` (for Mask R-CNN models).
         """
-        # get the original image sizes
-        original_image_sizes: List[Tuple[int, int]] = []
-
-        if not self.training:
-            for img in inputs:
-                val = img.shape[-2:]
-                assert len(val) == 2
-                original_image_sizes.append((val[0], val[1]))
-
-        # Transform the input
-        samples, targets = self.transform(inputs, targets)
-        # Compute the detections
-        outputs = self.model(samples.tensors, targets=targets)
+        # Transform the input and compute the detections, the outputs of the model are
+        # always a (Losses, Detections) tuple
+        if torch.jit.is_scripting():
+            samples, targets = self.transform(inputs, targets)
+            images = samples.tensors
+            if self.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            outputs = self.model(images, targets=targets)
+        else:
+            samples, targets = self._transform_eager(inputs, targets)
+            outputs = self._model_eager(samples.tensors, targets)
 
         losses = {}
         detections: List[Dict[str, Tensor]] = []
 
         if self.training:
             # compute the losses
-            if torch.jit.is_scripting():
-                losses = outputs[0]
-            else:
-                losses = outputs
+            losses = outputs[0]
         else:
+            # get the original image sizes
+            original_image_sizes = get_image_sizes(inputs)
             # Rescale coordinate
             detections = self.transform.postprocess(outputs, samples.image_sizes, original_image_sizes)
 
@@ -112,6 +146,64 @@ class YOLOModule(LightningModule):
         else:
             return self.eager_outputs(losses, detections)
 
+    @torch.jit.unused
+    def _transform_eager(
+        self,
+        inputs: List[Tensor],
+        targets: Optional[List[Dict[str, Tensor]]] = None,
+    ) -> Tuple[NestedTensor, Optional[Tensor]]:
+        # The ONNX exporting relies on the tracing path of the eager transform
+        if not self.training and not torchvision._is_tracing():
+            transform_scripted = self._get_transform_scripted()
+            if transform_scripted is not None:
+                return transform_scripted(inputs, targets)
+        return self.transform(inputs, targets)
+
+    @torch.jit.unused
+    def _get_transform_scripted(self) -> Optional[torch.jit.ScriptModule]:
+        """
+        The scripted transform is used for eager inference to reduce the Python overhead.
+        It is scripted lazily and cached outside of the module, so that it is neither
+        registered as a submodule nor pickled, and it is re-scripted when ``self.transform``
+        is replaced or its sizes are changed.
+        """
+        cache_key = (self.transform, tuple(self.transform.min_size), self.transform.max_size)
+        cached = _TRANSFORM_SCRIPTED_CACHE.get(self)
+        if cached is not None and cached[0][0] is cache_key[0] and cached[0][1:] == cache_key[1:]:
+            return cached[1]
+
+        try:
+            transform_scripted = torch.jit.script(self.transform)
+        except Exception:
+            warnings.warn("Failed to script the transform, fallback to the eager one.")
+            transform_scripted = None
+
+        _TRANSFORM_SCRIPTED_CACHE[self] = (cache_key, transform_scripted)
+        return transform_scripted
+
+    @torch.jit.unused
+    def _model_eager(
+        self,
+        samples: Tensor,
+        targets: Optional[Tensor] = None,
+    ) -> Tuple[Dict[str, Tensor], List[Dict[str, Tensor]]]:
+        if self.channels_last:
+            samples = samples.contiguous(memory_format=torch.channels_last)
+        enabled = self.amp and not self.training and samples.is_cuda
+        with torch.cuda.amp.autocast(enabled=enabled):
+            outputs = self.model(samples, targets=targets)
+
+        if enabled:
+            # Cast the detections back to FP32 for numerical safety
+            for det in outputs:
+                det["boxes"] = det["boxes"].float()
+                det["scores"] = det["scores"].float()
+
+        # Align with the (Losses, Detections) tuple returned in scripting
+        if self.training:
+            return outputs, []
+        return {}, outputs
+
     @torch.jit.unused
     def eager_outputs(
         self,
@@ -131,15 +223,50 @@ class YOLOModule(LightningModule):
         """
         This exists since PyTorchLightning forward are used for inference only (separate from
         ``training_step``). We keep ``targets`` here for Backward Compatible.
+
+        In eager mode, ``inputs`` can also be a batched tensor of shape ``[N, C, H, W]``.
         """
+        if isinstance(inputs, Tensor):
+            return self._forward_impl_batched(inputs, targets)
         return self._forward_impl(inputs, targets)
 
+    @torch.jit.unused
+    def _forward_impl_batched(
+        self,
+        batched: Tensor,
+        targets: Optional[List[Dict[str, Tensor]]] = None,
+    ) -> List[Dict[str, Tensor]]:
+        """
+        Fast path for a batched tensor, the transform is skipped when the images are already
+        at the resolution of the model, in which case the detections need no rescaling.
+        """
+        if self.training or not self._is_model_resolution(batched):
+            return self._forward_impl(list(batched.unbind(0)), targets)
+
+        return self._model_eager(batched)[1]
+
+    @torch.jit.unused
+    def _is_model_resolution(self, batched: Tensor) -> bool:
+        """
+        Check whether the transform would leave the images unchanged, i.e. they need neither
+        resizing nor padding.
+        """
+        height, width = batched.shape[-2:]
+        if height % 32 != 0 or width % 32 != 0:
+            return False
+
+        scale_factor = self.transform.min_size[-1] / min(height, width)
+        if max(height, width) * scale_factor > self.transform.max_size:
+            scale_factor = self.transform.max_size / max(height, width)
+
+        return scale_factor == 1.
+
     def training_step(self, batch, batch_idx):
         """
         The training step.
         """
         loss_dict = self._forward_impl(*batch)
-        loss = sum(loss_dict.values())
+        loss = torch.stack(tuple(loss_dict.values())).sum()
         self.log_dict(loss_dict, on_step=True, on_epoch=True, prog_bar=True)
         return loss
 
@@ -147,29 +274,41 @@ class YOLOModule(LightningModule):
         images, targets = batch
         # fasterrcnn takes only images for eval() mode
         preds = self._forward_impl(images)
-        iou = torch.stack([_evaluate_iou(t, o) for t, o in zip(targets, preds)]).mean()
-        outs = {"val_iou": iou}
-        self.log_dict(outs, on_step=True, on_epoch=True, prog_bar=True)
-        return outs
+        iou = _evaluate_iou(targets, preds)
+        self._val_iou_sum += iou.detach()
+        self._val_iou_count += 1
+        # The epoch average is computed from the running accumulator in validation_epoch_end
+        self.log("val_iou", iou, on_step=True, on_epoch=False, prog_bar=True)
 
     def validation_epoch_end(self, outs):
-        avg_iou = torch.stack([o["val_iou"] for o in outs]).mean()
+        avg_iou = self._val_iou_sum / self._val_iou_count
+        self._val_iou_sum.zero_()
+        self._val_iou_count.zero_()
         self.log("avg_val_iou", avg_iou)
 
     def test_step(self, batch, batch_idx):
         """
         The test step.
         """
+        # The batch has been moved to the device with non-blocking copies by Lightning
         images, targets = batch
-        images = list(image.to(self.device) for image in images)
         preds = self._forward_impl(images)
-        results = self.evaluator(preds, targets)
-        # log step metric
-        self.log('eval_step', results, prog_bar=True, on_step=True)
+        self._pending_test_preds.extend({k: v.detach() for k, v in p.items()} for p in preds)
+        self._pending_test_targets.extend(targets)
+        if len(self._pending_test_preds) >= self._eval_chunk_size:
+            self._flush_test_evaluation()
 
     def test_epoch_end(self, outputs):
+        self._flush_test_evaluation()
         return self.log('coco_eval', self.evaluator.compute())
 
+    @torch.jit.unused
+    def _flush_test_evaluation(self) -> None:
+        if len(self._pending_test_preds) > 0:
+            self.evaluator.update(self._pending_test_preds, self._pending_test_targets)
+        self._pending_test_preds = []
+        self._pending_test_targets = []
+
     @torch.no_grad()
     def predict(
         self,
@@ -200,34 +339,182 @@ class YOLOModule(LightningModule):
             The post-processed model predictions
 
         """
-        data_pipeline = data_pipeline or self.data_pipeline
+        data_pipeline = data_pipeline or self._data_pipeline
         batch = x if skip_collate_fn else data_pipeline.collate_fn(x)
         images, _ = batch if len(batch) == 2 and isinstance(batch, (list, tuple)) else (batch, None)
-        images = [img.to(self.device) for img in images]
+        images = self._images_to_device(images)
         predictions = self.forward(images)
         output = data_pipeline.uncollate_fn(predictions)  # TODO: pass batch and x
         return output
 
+    @torch.jit.unused
+    def _images_to_device(self, images: List[Tensor]) -> List[Tensor]:
+        """
+        Copy the images to the device of the model. On cuda device, the images sharing the
+        same shape are stacked directly into pinned memory, so that a single non-blocking
+        copy replaces the per-image copies.
+        """
+        device = self.device
+        if (device.type != 'cuda' or len(images) == 1 or any(img.is_cuda for img in images)
+                or any(img.shape != images[0].shape for img in images)):
+            return [img.to(device, non_blocking=True) for img in images]
+
+        batch = torch.empty((len(images),) + tuple(images[0].shape), dtype=images[0].dtype, pin_memory=True)
+        torch.stack(images, out=batch)
+        return list(batch.to(device, non_blocking=True).unbind(0))
+
+    @torch.jit.unused
+    @torch.no_grad()
+    def warmup(self, batch_size: int = 1, height: Optional[int] = None, width: Optional[int] = None) -> None:
+        """
+        Run the inference on dummy images, which triggers the (slow) compilation of the
+        compiled model ahead of time. The dummy images should have the same batch size
+        and shape as the images to be predicted.
+
+        Args:
+            batch_size: number of images in a batch
+            height: height of the images, default is the ``min_size`` of the transform
+            width: width of the images, default is the ``max_size`` of the transform
+        """
+        height = height or self.transform.min_size[-1]
+        width = width or self.transform.max_size
+        images = [torch.zeros((3, height, width), device=self.device) for _ in range(batch_size)]
+
+        mode = self.training
+        self.eval()
+        try:
+            # The CUDA graphs are recorded on the second run
+            for _ in range(2):
+                self.forward(images)
+        finally:
+            self.train(mode)
+
+    @torch.jit.unused
+    def _add_compiled_prefix(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                             unexpected_keys, error_msgs):
+        model_prefix = prefix + 'model.'
+        for key in list(state_dict.keys()):
+            if key.startswith(model_prefix) and not key.startswith(model_prefix + '_orig_mod.'):
+                new_key = model_prefix + '_orig_mod.' + key[len(model_prefix):]
+                state_dict[new_key] = state_dict.pop(key)
+
     def configure_optimizers(self):
-        return torch.optim.SGD(
-            self.model.parameters(),
-            lr=self.lr,
-            momentum=0.9,
-            weight_decay=0.005,
-        )
+        # Following the upstream YOLOv5, apply no weight decay to the biases and BN weights
+        params_decay, params_no_decay = [], []
+        for param in self.model.parameters():
+            if not param.requires_grad:
+                continue
+            if param.ndim <= 1:
+                params_no_decay.append(param)
+            else:
+                params_decay.append(param)
+
+        param_groups = [
+            {'params': params_decay, 'weight_decay': 0.005},
+            {'params': params_no_decay, 'weight_decay': 0.},
+        ]
+        # Update the parameters with the multi-tensor kernels, fall back in order of preference
+        # when the installed PyTorch doesn't support them
+        multi_tensor_kwargs = [{'foreach': True}]
+        if all(param.is_cuda for param in params_decay + params_no_decay):
+            multi_tensor_kwargs.insert(0, {'fused': True})
+
+        for kwargs in multi_tensor_kwargs:
+            try:
+                return torch.optim.SGD(param_groups, lr=self.lr, momentum=0.9, **kwargs)
+            except TypeError:
+                continue
+
+        try:
+            # PyTorch 1.7 and 1.8 ship the multi-tensor implementation in a separate namespace
+            from torch.optim._multi_tensor import SGD
+        except ImportError:
+            SGD = torch.optim.SGD
+
+        return SGD(param_groups, lr=self.lr, momentum=0.9)
+
+    @torch.jit.unused
+    def to_torchscript_inference(self) -> torch.jit.ScriptModule:
+        """
+        Script the pre-processing, the detector and the post-processing (including NMS) into
+        a single frozen TorchScript module for deployment, bypassing the Python overhead of
+        ``_forward_impl``.
+
+        Note: The first calls of the exported module will be slow as the profiling executor
+        specializes the graph, wrap the inference with ``torch.jit.optimized_execution(False)``
+        to avoid it.
+        """
+        if self._is_compiled:
+            raise RuntimeError("The compiled model can not be exported, set compile_model to False.")
+
+        mode = self.training
+        self.eval()
+        try:
+            scripted_model = torch.jit.script(self)
+        finally:
+            self.train(mode)
+
+        if hasattr(torch.jit, 'freeze'):
+            scripted_model = torch.jit.freeze(scripted_model)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            scripted_model = torch.jit.optimize_for_inference(scripted_model)
+
+        return scripted_model
+
+    @torch.jit.unused
+    def export(
+        self,
+        file_path: Union[str, PosixPath],
+        fmt: str = 'torchscript',
+        example_inputs: Optional[List[Tensor]] = None,
+    ) -> None:
+        """
+        Export the model for deployment inference.
+
+        Args:
+            file_path: the path of the exported model
+            fmt: the format to export, possible values are 'torchscript' and 'onnx'
+            example_inputs: images used to trace the model, only required when exporting ONNX.
+                Please construct the model with ``export_friendly=True`` when exporting ONNX.
+        """
+        if self._is_compiled:
+            raise RuntimeError("The compiled model can not be exported, set compile_model to False.")
+
+        if fmt == 'torchscript':
+            scripted_model = self.to_torchscript_inference()
+            torch.jit.save(scripted_model, str(file_path))
+        elif fmt == 'onnx':
+            if example_inputs is None:
+                raise ValueError("example_inputs is required when exporting ONNX.")
+
+            from torchvision.ops._register_onnx_ops import _onnx_opset_version
+
+            mode = self.training
+            self.eval()
+            try:
+                torch.onnx.export(
+                    self,
+                    (example_inputs,),
+                    str(file_path),
+                    do_constant_folding=True,
+                    opset_version=_onnx_opset_version,
+                    input_names=["images_tensors"],
+                    output_names=["outputs"],
+                    dynamic_axes={"images_tensors": [0, 1, 2], "outputs": [0, 1, 2]},
+                )
+            finally:
+                self.train(mode)
+        else:
+            raise NotImplementedError(f"Currently only supports exporting torchscript and onnx, got {fmt}")
 
     @torch.jit.unused
     @property
     def data_pipeline(self) -> DataPipeline:
-        # we need to save the pipeline in case this class
-        # is loaded from checkpoint and used to predict
-        if not self._data_pipeline:
-            self._data_pipeline = self.default_pipeline()
         return self._data_pipeline
 
     @data_pipeline.setter
     def data_pipeline(self, data_pipeline: DataPipeline) -> None:
-        self._data_pipeline = data_pipeline
+        self._data_pipeline = data_pipeline or self.default_pipeline()
 
     @staticmethod
     def default_pipeline() -> DataPipeline:
@@ -250,4 +537,18 @@ class YOLOModule(LightningModule):
                             help='momentum')
         parser.add_argument('--weight-decay', default=5e-4, type=float,
                             metavar='W', help='weight decay (default: 5e-4)')
+        parser.add_argument('--channels-last', action='store_true',
+                            help='Use the channels last memory format for the convolutions')
+        parser.add_argument('--amp', action='store_true',
+                            help='Use FP16 autocast for inference on cuda device')
+        parser.add_argument('--compile', dest='compile_model', action='store_true',
+                            help='Compile the model with torch.compile (PyTorch 2.0+)')
         return parser
+
+
+def _strip_compiled_prefix(module, state_dict, prefix, local_metadata):
+    compiled_prefix = prefix + 'model._orig_mod.'
+    for key in list(state_dict.keys()):
+        if key.startswith(compiled_prefix):
+            state_dict[prefix + 'model.' + key[len(compiled_prefix):]] = state_dict.pop(key)
+    return state_dict